@@ -0,0 +1,79 @@
+import asyncio
+from typing import Awaitable, Callable, List, Set, Tuple
+
+import numpy as np
+
+# (texts, future) as queued by one /embeddings request
+PendingItem = Tuple[List[str], asyncio.Future]
+EncodeFn = Callable[[List[str]], Awaitable[np.ndarray]]
+
+
+async def encode_pending(
+    items: List[PendingItem], encode: EncodeFn, semaphore: asyncio.Semaphore
+) -> None:
+    """Encode coalesced requests in one call and hand each caller its rows
+
+    The caller has already acquired a semaphore slot for this call.
+    """
+    all_texts = [text for texts, _ in items for text in texts]
+    try:
+        embeddings = await encode(all_texts)
+    except Exception as e:
+        for _, future in items:
+            if not future.done():
+                future.set_exception(e)
+        return
+    finally:
+        semaphore.release()
+
+    offset = 0
+    for texts, future in items:
+        if not future.done():
+            future.set_result(embeddings[offset : offset + len(texts)])
+        offset += len(texts)
+
+
+async def run_batcher(
+    queue: "asyncio.Queue[PendingItem]",
+    semaphore: asyncio.Semaphore,
+    encode: EncodeFn,
+    batch_size: int,
+    window_ms: float,
+    tasks: Set[asyncio.Task],
+) -> None:
+    """Coalesce queued requests into encode calls of up to batch_size texts"""
+    loop = asyncio.get_running_loop()
+    while True:
+        # Wait for a free encode slot before collecting, so everything queued
+        # while the previous encode ran is merged into the next call
+        await semaphore.acquire()
+        try:
+            items = [await queue.get()]
+            total = len(items[0][0])
+            deadline = loop.time() + window_ms / 1000
+
+            while total < batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                items.append(item)
+                total += len(item[0])
+        except BaseException:
+            semaphore.release()
+            raise
+
+        # Drop callers that went away while queued
+        items = [item for item in items if not item[1].done()]
+        if not items:
+            semaphore.release()
+            continue
+
+        # Encode in the background so the next batch can be collected once
+        # another slot frees up; encode_pending releases this one
+        task = asyncio.create_task(encode_pending(items, encode, semaphore))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
@@ -1,51 +1,250 @@
 import asyncio
+import json
 import logging
 import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
+import numpy as np
+import orjson
 import torch
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict
 from sentence_transformers import SentenceTransformer
+from sentence_transformers.models import Normalize, Pooling, Transformer
+
+from batching import run_batcher
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Embedding Service", version="1.0.0")
+app = FastAPI(
+    title="Embedding Service",
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+)
 
 MODEL_NAME = os.getenv("MODEL_NAME", "all-MiniLM-L6-v2")
 BATCH_SIZE = int(os.getenv("BATCH_SIZE", "32"))
 MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "5"))
 TORCH_NUM_THREADS = int(os.getenv("TORCH_NUM_THREADS", "2"))
+# Concurrent model.encode calls; each one already uses TORCH_NUM_THREADS threads,
+# so on CPU running more than one at a time only oversubscribes the cores
+ENCODE_CONCURRENCY = int(
+    os.getenv("ENCODE_CONCURRENCY", "4" if torch.cuda.is_available() else "1")
+)
+# How long the batcher waits for more requests to coalesce into one encode call
+BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", "5"))
+# "torch" runs the stock SentenceTransformer, "onnx" an INT8-quantized ONNX export
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR", "/app/models")
+SENTENCE_CONFIG_FILE = "sentence_bert_config.json"
+# Opt-in since Inductor needs a C compiler, which the slim image does not ship
+TORCH_COMPILE = os.getenv("TORCH_COMPILE", "false").lower() == "true"
+# Binary /embeddings rows are little-endian float16 whatever the host byte order
+EMBEDDING_WIRE_DTYPE = np.dtype("<f2")
 
 model = None
+tokenizer = None
+direct_forward = False
 request_semaphore = None
+encode_semaphore = None
+encode_executor = None
+pending_queue = None
+batcher_task = None
+encode_tasks = set()
+
+
+class OnnxEmbedder:
+    """INT8-quantized ONNX Runtime drop-in for SentenceTransformer.encode"""
+
+    def __init__(self, model_name: str, cache_folder: str):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        model_id = model_name
+        if "/" not in model_id:
+            model_id = f"sentence-transformers/{model_id}"
+        model_dir = os.path.join(
+            cache_folder, "onnx", model_id.replace("/", "_") + "-int8"
+        )
+        model_path = os.path.join(model_dir, "model_quantized.onnx")
+        if not os.path.exists(model_path):
+            self._export_quantized(model_id, model_dir)
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir, use_fast=True)
+        # Truncate where SentenceTransformer would (max_seq_length), not at the
+        # tokenizer's limit, so long texts embed the same on both backends
+        config_path = os.path.join(model_dir, SENTENCE_CONFIG_FILE)
+        if not os.path.exists(config_path):
+            self._save_sentence_config(model_id, model_dir)
+        sentence_config = {}
+        if os.path.exists(config_path):
+            with open(config_path) as f:
+                sentence_config = json.load(f)
+        self.max_length = sentence_config.get(
+            "max_seq_length", min(self.tokenizer.model_max_length, 512)
+        )
+        self.do_lower_case = sentence_config.get("do_lower_case", False)
+
+        sess_options = ort.SessionOptions()
+        sess_options.intra_op_num_threads = TORCH_NUM_THREADS
+        self.session = ort.InferenceSession(
+            model_path, sess_options=sess_options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    @staticmethod
+    def _export_quantized(model_id: str, model_dir: str) -> None:
+        """Export the model to ONNX and apply dynamic INT8 quantization"""
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+
+        logger.info(f"Exporting {model_id} to quantized ONNX in {model_dir}")
+        ort_model = ORTModelForFeatureExtraction.from_pretrained(model_id, export=True)
+        quantizer = ORTQuantizer.from_pretrained(ort_model)
+        quantizer.quantize(
+            save_dir=model_dir,
+            quantization_config=AutoQuantizationConfig.avx512_vnni(
+                is_static=False, per_channel=False
+            ),
+        )
+        AutoTokenizer.from_pretrained(model_id).save_pretrained(model_dir)
+        OnnxEmbedder._save_sentence_config(model_id, model_dir)
+
+    @staticmethod
+    def _save_sentence_config(model_id: str, model_dir: str) -> None:
+        """Copy the model's sentence_bert_config.json next to the export"""
+        from huggingface_hub import hf_hub_download
+        from huggingface_hub.utils import EntryNotFoundError
+
+        try:
+            path = hf_hub_download(model_id, SENTENCE_CONFIG_FILE)
+        except EntryNotFoundError:
+            logger.warning(f"{model_id} has no {SENTENCE_CONFIG_FILE}")
+            return
+        shutil.copy(path, os.path.join(model_dir, SENTENCE_CONFIG_FILE))
+
+    def eval(self) -> "OnnxEmbedder":
+        return self
+
+    def encode(self, texts: List[str], batch_size: int = 32, **kwargs) -> np.ndarray:
+        """Mean-pooled, L2-normalized embeddings, matching sentence-transformers"""
+        # Same preprocessing as sentence-transformers' Transformer.tokenize
+        texts = [text.strip() for text in texts]
+        if self.do_lower_case:
+            texts = [text.lower() for text in texts]
+
+        all_embeddings = []
+        for batch in batch_texts(texts, batch_size):
+            encoded = self.tokenizer(
+                batch,
+                padding=True,
+                truncation=True,
+                max_length=self.max_length,
+                return_tensors="np",
+            )
+            inputs = {k: v for k, v in encoded.items() if k in self.input_names}
+            token_embeddings = self.session.run(None, inputs)[0]
+
+            mask = encoded["attention_mask"][..., None].astype(np.float32)
+            summed = (token_embeddings * mask).sum(axis=1)
+            pooled = summed / np.clip(mask.sum(axis=1), 1e-9, None)
+            norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+            all_embeddings.append(pooled / np.clip(norms, 1e-12, None))
+
+        return np.concatenate(all_embeddings).astype(np.float32)
+
+
+def load_model():
+    if EMBEDDING_BACKEND == "onnx":
+        return OnnxEmbedder(MODEL_NAME, cache_folder=MODEL_CACHE_DIR)
+    return SentenceTransformer(MODEL_NAME, cache_folder=MODEL_CACHE_DIR)
+
+
+def supports_direct_forward(st_model) -> bool:
+    """True for Transformer -> mean Pooling [-> Normalize] pipelines"""
+    if not isinstance(st_model, SentenceTransformer):
+        return False
+    modules = list(st_model)
+    return (
+        len(modules) >= 2
+        and isinstance(modules[0], Transformer)
+        and isinstance(modules[1], Pooling)
+        and modules[1].get_pooling_mode_str() == "mean"
+        and all(isinstance(m, Normalize) for m in modules[2:])
+    )
 
 
 @app.on_event("startup")
 async def startup_event():
-    global model, request_semaphore
+    global model, tokenizer, direct_forward
+    global request_semaphore, encode_semaphore, encode_executor
+    global pending_queue, batcher_task
 
     # Configure PyTorch for memory efficiency
     torch.set_num_threads(TORCH_NUM_THREADS)
+    torch.set_float32_matmul_precision("high")
     if torch.cuda.is_available():
         torch.cuda.empty_cache()
 
     # Initialize request limiting
     request_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
-    logger.info(f"Loading model: {MODEL_NAME}")
+    # Dedicated encode pool instead of the default executor
+    encode_semaphore = asyncio.Semaphore(ENCODE_CONCURRENCY)
+    encode_executor = ThreadPoolExecutor(
+        max_workers=ENCODE_CONCURRENCY, thread_name_prefix="st-encode"
+    )
+
+    logger.info(f"Loading model: {MODEL_NAME} ({EMBEDDING_BACKEND} backend)")
     try:
-        model = SentenceTransformer(MODEL_NAME, cache_folder="/app/models")
+        model = load_model()
         # Optimize model for inference
         model.eval()
+        # Tokenize with the cached fast tokenizer and call the transformer
+        # directly when the pooling is something we can reproduce
+        direct_forward = supports_direct_forward(model)
+        if direct_forward:
+            tokenizer = model.tokenizer
+        if TORCH_COMPILE and isinstance(model, SentenceTransformer):
+            await compile_model()
         logger.info(f"Model loaded successfully with batch_size={BATCH_SIZE}")
     except Exception as e:
         logger.error(f"Failed to load model: {e}")
         raise e
 
+    # Start the cross-request micro-batcher
+    pending_queue = asyncio.Queue()
+    batcher_task = asyncio.create_task(
+        run_batcher(
+            pending_queue,
+            encode_semaphore,
+            encode_in_executor,
+            BATCH_SIZE,
+            BATCH_WINDOW_MS,
+            encode_tasks,
+        )
+    )
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if batcher_task is not None:
+        batcher_task.cancel()
+    if encode_executor is not None:
+        encode_executor.shutdown(wait=False)
+
 
 class EmbeddingRequest(BaseModel):
+    # Fail fast on pathologically large texts; anything under the cap is still
+    # tokenized and truncated to the model's max sequence length
+    model_config = ConfigDict(extra="forbid", str_max_length=100_000)
+
     texts: List[str]
 
 
@@ -58,37 +257,148 @@ def batch_texts(texts: List[str], batch_size: int) -> List[List[str]]:
     return [texts[i : i + batch_size] for i in range(0, len(texts), batch_size)]
 
 
+def encode_batch(batch: List[str]) -> np.ndarray:
+    """Mean-pooled unit vectors straight from the underlying transformer"""
+    # Same preprocessing as Transformer.tokenize
+    batch = [text.strip() for text in batch]
+    if model[0].do_lower_case:
+        batch = [text.lower() for text in batch]
+    encoded = tokenizer(
+        batch,
+        padding=True,
+        truncation=True,
+        max_length=model.max_seq_length,
+        return_tensors="pt",
+    ).to(model.device)
+    token_embeddings = model[0].auto_model(**encoded)[0]
+    mask = encoded["attention_mask"].unsqueeze(-1).to(token_embeddings.dtype)
+    pooled = (token_embeddings * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+    pooled = torch.nn.functional.normalize(pooled, p=2, dim=1)
+    return pooled.float().cpu().numpy()
+
+
+def encode_texts(texts: List[str]) -> np.ndarray:
+    """Encode texts to unit-length vectors in BATCH_SIZE batches"""
+    # Smart batching: group similar lengths so batches carry little padding,
+    # then scatter the rows back to request order
+    order = np.argsort([-len(text) for text in texts], kind="stable")
+    sorted_texts = [texts[i] for i in order]
+
+    # Each batch is written into one preallocated array
+    out = None
+    offset = 0
+    with torch.inference_mode():
+        for batch in batch_texts(sorted_texts, BATCH_SIZE):
+            if direct_forward:
+                batch_embeddings = encode_batch(batch)
+            else:
+                batch_embeddings = model.encode(
+                    batch,
+                    convert_to_numpy=True,
+                    normalize_embeddings=True,
+                    show_progress_bar=False,
+                )
+
+            if out is None:
+                out = np.empty(
+                    (len(texts), batch_embeddings.shape[1]), dtype=np.float32
+                )
+            out[order[offset : offset + len(batch)]] = batch_embeddings
+            offset += len(batch)
+
+    return out
+
+
+def _warm_up_encode_thread(lock: threading.Lock, barrier: threading.Barrier) -> None:
+    """Trace the common sequence-length buckets on this encode thread"""
+    try:
+        # One thread compiles at a time; the barrier keeps each warm-up on its
+        # own thread, since CUDA graphs are recorded per thread
+        with lock:
+            for length in (32, 128, 256):
+                encode_texts(["hello " * length] * 2)
+    except Exception:
+        barrier.abort()
+        raise
+    barrier.wait()
+
+
+async def compile_model() -> None:
+    """Swap in a torch.compile'd transformer and warm it up, or stay eager"""
+    transformer = model[0]
+    eager_model = transformer.auto_model
+    transformer.auto_model = torch.compile(
+        eager_model, dynamic=True, mode="reduce-overhead"
+    )
+
+    # Warm up every st-encode thread, since those are the ones serving traffic
+    lock = threading.Lock()
+    barrier = threading.Barrier(ENCODE_CONCURRENCY)
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(
+        *[
+            loop.run_in_executor(encode_executor, _warm_up_encode_thread, lock, barrier)
+            for _ in range(ENCODE_CONCURRENCY)
+        ],
+        return_exceptions=True,
+    )
+    errors = [
+        r
+        for r in results
+        if isinstance(r, Exception) and not isinstance(r, threading.BrokenBarrierError)
+    ]
+    if errors:
+        logger.warning(f"torch.compile failed, using eager model: {errors[0]}")
+        transformer.auto_model = eager_model
+    else:
+        logger.info("Transformer compiled with torch.compile")
+
+
+async def encode_in_executor(texts: List[str]) -> np.ndarray:
+    """Run encode_texts on the dedicated encode pool"""
+    return await asyncio.get_running_loop().run_in_executor(
+        encode_executor, encode_texts, texts
+    )
+
+
 @app.get("/health")
 async def health_check():
     return {"status": "healthy", "model": MODEL_NAME}
 
 
-@app.post("/embeddings", response_model=EmbeddingResponse)
-async def create_embeddings(request: EmbeddingRequest):
+# Responses are built from trusted ndarrays, so skip per-float validation and
+# keep EmbeddingResponse for the OpenAPI schema only
+@app.post(
+    "/embeddings",
+    response_model=None,
+    responses={200: {"model": EmbeddingResponse}},
+)
+async def create_embeddings(request: EmbeddingRequest, http_request: Request):
     if model is None:
         raise HTTPException(status_code=500, detail="Model not loaded")
 
     async with request_semaphore:
         try:
-            # Process in batches to manage memory
-            all_embeddings = []
-            text_batches = batch_texts(request.texts, BATCH_SIZE)
-
-            for batch in text_batches:
-                # Run encoding in thread pool to avoid blocking
-                batch_embeddings = await asyncio.get_event_loop().run_in_executor(
-                    None,
-                    lambda: model.encode(
-                        batch, convert_to_tensor=False, show_progress_bar=False
-                    ),
-                )
-                all_embeddings.extend(batch_embeddings.tolist())
+            if request.texts:
+                future = asyncio.get_running_loop().create_future()
+                await pending_queue.put((request.texts, future))
+                embeddings = await future
+            else:
+                embeddings = np.empty((0, 0), dtype=np.float32)
 
-                # Clear memory between batches
-                if torch.cuda.is_available():
-                    torch.cuda.empty_cache()
+            # Binary float16 rows skip JSON encoding on both ends
+            if "application/octet-stream" in http_request.headers.get("accept", ""):
+                arr = embeddings.astype(EMBEDDING_WIRE_DTYPE)
+                return Response(
+                    content=arr.tobytes(),
+                    media_type="application/octet-stream",
+                    headers={"X-Shape": f"{arr.shape[0]},{arr.shape[1]}"},
+                )
 
-            return EmbeddingResponse(embeddings=all_embeddings)
+            # orjson writes the float32 rows directly, no .tolist() needed
+            return ORJSONResponse(
+                {"embeddings": embeddings}, option=orjson.OPT_SERIALIZE_NUMPY
+            )
 
         except Exception as e:
             logger.error(f"Error creating embeddings: {e}")
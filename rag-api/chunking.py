@@ -0,0 +1,121 @@
+from typing import Any, AsyncIterator, List, Optional
+
+import numpy as np
+
+try:
+    import hyperscan
+except ImportError:  # optional; chunking falls back to a numpy scan
+    hyperscan = None
+
+# Sentence punctuation followed by whitespace; newlines always break. The
+# whitespace set is spelled out so the hyperscan and numpy scans agree on it
+SENTENCE_END_CHARS = ".!?;"
+WHITESPACE_CHARS = " \t\n\v\f\r"
+SENTENCE_END_PATTERN = rb"[.!?;][ \t\n\v\f\r]"
+SENTENCE_END_CODEPOINTS = [ord(c) for c in SENTENCE_END_CHARS]
+WHITESPACE_CODEPOINTS = [ord(c) for c in WHITESPACE_CHARS]
+
+
+def _compile_break_database() -> Optional[Any]:
+    """Hyperscan DFA for sentence breaks, or None when hyperscan is unavailable"""
+    if hyperscan is None:
+        return None
+    database = hyperscan.Database()
+    database.compile(
+        expressions=[SENTENCE_END_PATTERN, b"\n"],
+        ids=[1, 2],
+        flags=[hyperscan.HS_FLAG_SOM_LEFTMOST] * 2,
+    )
+    return database
+
+
+def _on_break_match(
+    match_id: int, start: int, end: int, flags: int, context: List[int]
+) -> None:
+    context.append(start)
+
+
+def _find_breaks(text: str) -> np.ndarray:
+    """Offsets of every sentence/newline break in text, as str indices"""
+    if break_database is not None:
+        data = text.encode("utf-8", "surrogatepass")
+        matches = []
+        break_database.scan(data, match_event_handler=_on_break_match, context=matches)
+        offsets = np.unique(np.asarray(matches, dtype=np.int64))
+        if len(data) == len(text):
+            return offsets
+        # Map byte offsets to character offsets by discounting continuation bytes
+        buf = np.frombuffer(data, dtype=np.uint8)
+        continuation = np.cumsum((buf & 0xC0) == 0x80)
+        return offsets - continuation[offsets]
+
+    # One code point per character keeps the offsets aligned with str indices
+    codepoints = np.frombuffer(
+        text.encode("utf-32-le", "surrogatepass"), dtype=np.uint32
+    )
+    sentence_end = np.isin(codepoints[:-1], SENTENCE_END_CODEPOINTS) & np.isin(
+        codepoints[1:], WHITESPACE_CODEPOINTS
+    )
+    return np.flatnonzero(np.append(sentence_end, False) | (codepoints == ord("\n")))
+
+
+break_database = _compile_break_database()
+
+
+def _chunk_end(breaks: np.ndarray, start: int, chunk_size: int) -> int:
+    """End of the window at start, moved back to a late enough sentence break"""
+    end = start + chunk_size
+    i = np.searchsorted(breaks, end) - 1
+    if i >= 0 and breaks[i] > start + chunk_size // 2:
+        end = int(breaks[i]) + 1
+    return end
+
+
+def chunk_text(text: str, chunk_size: int = 500, overlap: int = 50) -> List[str]:
+    """Simple text chunking by character count with overlap"""
+    if len(text) <= chunk_size:
+        return [text]
+
+    breaks = _find_breaks(text)
+
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = start + chunk_size
+
+        # Try to break at sentence boundary
+        if end < len(text):
+            end = _chunk_end(breaks, start, chunk_size)
+
+        chunks.append(text[start:end].strip())
+        if end >= len(text):
+            break
+        start = end - overlap
+
+    return [chunk for chunk in chunks if chunk]
+
+
+async def stream_chunks(
+    pieces: AsyncIterator[str], chunk_size: int = 500, overlap: int = 50
+) -> AsyncIterator[str]:
+    """Streaming chunk_text: emit each window as soon as the text after it arrives"""
+    buffer = ""
+    async for piece in pieces:
+        buffer += piece
+        if len(buffer) <= chunk_size:
+            continue
+
+        breaks = _find_breaks(buffer)
+        start = 0
+        while start + chunk_size < len(buffer):
+            end = _chunk_end(breaks, start, chunk_size)
+            chunk = buffer[start:end].strip()
+            if chunk:
+                yield chunk
+            start = end - overlap
+        buffer = buffer[start:]
+
+    # What is left always fits in one final window
+    tail = buffer.strip()
+    if tail:
+        yield tail
@@ -1,66 +1,184 @@
 import asyncio
+import codecs
+import hashlib
 import logging
 import os
-import uuid
-from typing import List, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import AsyncIterator, Dict, List, Optional, Union
 
 import httpx
+import numpy as np
+from cachetools import TTLCache
 from fastapi import FastAPI, File, HTTPException, UploadFile
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-from qdrant_client import QdrantClient
-from qdrant_client.models import Distance, PointStruct, VectorParams
+from qdrant_client import AsyncQdrantClient
+from qdrant_client.models import (
+    Distance,
+    HnswConfigDiff,
+    OptimizersConfigDiff,
+    PointStruct,
+    QuantizationSearchParams,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    SearchParams,
+    VectorParams,
+)
+
+from chunking import chunk_text, stream_chunks
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="RAG API", version="1.0.0")
+app = FastAPI(title="RAG API", version="1.0.0", default_response_class=ORJSONResponse)
 
 QDRANT_HOST = os.getenv("QDRANT_HOST", "localhost")
 QDRANT_PORT = os.getenv("QDRANT_PORT", "6333")
+QDRANT_GRPC_PORT = os.getenv("QDRANT_GRPC_PORT", "6334")
 EMBEDDING_SERVICE_URL = os.getenv("EMBEDDING_SERVICE_URL", "http://localhost:8001")
+# "http" calls the embedding service, "inproc" loads the model into this process
+EMBEDDING_MODE = os.getenv("EMBEDDING_MODE", "http")
+MODEL_NAME = os.getenv("MODEL_NAME", "all-MiniLM-L6-v2")
+TORCH_NUM_THREADS = int(os.getenv("TORCH_NUM_THREADS", "1"))
+VECTOR_SIZE = 768
 COLLECTION_NAME = "documents"
 MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "10"))
 REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "30"))
 MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "50"))
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", "256"))
+IO_WORKERS = int(os.getenv("IO_WORKERS", "8"))
+# Upload processes per bulk ingest; each one is a forked worker in this container
+UPLOAD_PARALLEL = int(os.getenv("UPLOAD_PARALLEL", "1"))
+# Chunk embeddings kept in memory so repeated text skips the embedding service
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "10000"))
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "4096"))
+QUERY_CACHE_TTL = int(os.getenv("QUERY_CACHE_TTL", "3600"))
+INDEXING_THRESHOLD = 20000
+# Binary /embeddings rows are little-endian float16 whatever the host byte order
+EMBEDDING_WIRE_DTYPE = np.dtype("<f2")
 
 qdrant_client = None
 request_semaphore = None
+bulk_ingest_lock = None
+point_id_rng = np.random.default_rng()
+embedding_cache = OrderedDict()
+query_cache = TTLCache(maxsize=max(QUERY_CACHE_SIZE, 1), ttl=QUERY_CACHE_TTL)
 http_client = None
+io_executor = None
+embedding_model = None
+encode_executor = None
 
 
 @app.on_event("startup")
 async def startup_event():
-    global qdrant_client, request_semaphore, http_client
+    global qdrant_client, request_semaphore, http_client, io_executor, bulk_ingest_lock
+    global embedding_model, encode_executor
 
     # Initialize request limiting
     request_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
-    # Initialize persistent HTTP client
-    http_client = httpx.AsyncClient(timeout=REQUEST_TIMEOUT)
+    # indexing_threshold is collection-wide, so bulk loads take turns toggling it
+    bulk_ingest_lock = asyncio.Lock()
+
+    # Small dedicated pool for blocking file reads and bulk uploads
+    io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+
+    # Initialize persistent HTTP client with a sized keep-alive pool
+    http_client = httpx.AsyncClient(
+        timeout=REQUEST_TIMEOUT,
+        limits=httpx.Limits(
+            max_keepalive_connections=MAX_CONCURRENT_REQUESTS,
+            max_connections=MAX_CONCURRENT_REQUESTS * 2,
+            keepalive_expiry=60.0,
+        ),
+    )
+
+    vector_size = VECTOR_SIZE
+    if EMBEDDING_MODE == "inproc":
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        # Default is one intra-op thread per host core, far beyond this
+        # container's CPU share
+        torch.set_num_threads(TORCH_NUM_THREADS)
+
+        logger.info(f"Loading in-process embedding model: {MODEL_NAME}")
+        embedding_model = SentenceTransformer(MODEL_NAME)
+        embedding_model.eval()
+        vector_size = embedding_model.get_sentence_embedding_dimension()
+        encode_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="st-encode"
+        )
 
     logger.info(f"Connecting to Qdrant at {QDRANT_HOST}:{QDRANT_PORT}")
     try:
-        qdrant_client = QdrantClient(host=QDRANT_HOST, port=int(QDRANT_PORT))
+        qdrant_client = AsyncQdrantClient(
+            host=QDRANT_HOST,
+            port=int(QDRANT_PORT),
+            grpc_port=int(QDRANT_GRPC_PORT),
+            prefer_grpc=True,
+        )
 
         # Create collection if it doesn't exist
-        collections = qdrant_client.get_collections().collections
+        collections = (await qdrant_client.get_collections()).collections
         if not any(collection.name == COLLECTION_NAME for collection in collections):
-            qdrant_client.create_collection(
+            await qdrant_client.create_collection(
                 collection_name=COLLECTION_NAME,
-                vectors_config=VectorParams(size=768, distance=Distance.COSINE),
+                # Embeddings arrive unit-normalized, so dot product equals cosine
+                vectors_config=VectorParams(size=vector_size, distance=Distance.DOT),
+                # int8 scalar quantization kept in RAM for the bulk scan
+                quantization_config=ScalarQuantization(
+                    scalar=ScalarQuantizationConfig(
+                        type=ScalarType.INT8, quantile=0.99, always_ram=True
+                    )
+                ),
+                hnsw_config=HnswConfigDiff(m=32, ef_construct=256),
             )
             logger.info(f"Created collection: {COLLECTION_NAME}")
         else:
             logger.info(f"Collection {COLLECTION_NAME} already exists")
 
+        info = await qdrant_client.get_collection(COLLECTION_NAME)
+
     except Exception as e:
         logger.error(f"Failed to connect to Qdrant: {e}")
         raise e
 
+    # An existing collection keeps its original dimension, e.g. after switching
+    # EMBEDDING_MODE or MODEL_NAME, and every upsert and query would then fail
+    existing_size = getattr(info.config.params.vectors, "size", None)
+    if existing_size is not None and existing_size != vector_size:
+        message = (
+            f"Collection {COLLECTION_NAME} stores {existing_size}-dimensional "
+            f"vectors but the embedding model produces {vector_size}; "
+            f"check MODEL_NAME or recreate the collection"
+        )
+        logger.error(message)
+        raise RuntimeError(message)
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if http_client is not None:
+        await http_client.aclose()
+    if qdrant_client is not None:
+        await qdrant_client.close()
+    if io_executor is not None:
+        io_executor.shutdown(wait=False)
+    if encode_executor is not None:
+        encode_executor.shutdown(wait=False)
+
 
 class Document(BaseModel):
     text: str
-    metadata: Optional[dict] = {}
+    metadata: Dict[str, Union[str, bool, int, float]] = {}
+
+
+class BulkIngestRequest(BaseModel):
+    documents: List[Document]
 
 
 class QueryRequest(BaseModel):
@@ -72,37 +190,84 @@ class QueryResponse(BaseModel):
     results: List[dict]
 
 
-def chunk_text(text: str, chunk_size: int = 500, overlap: int = 50) -> List[str]:
-    """Simple text chunking by character count with overlap"""
-    if len(text) <= chunk_size:
-        return [text]
-
-    chunks = []
-    start = 0
-    while start < len(text):
-        end = start + chunk_size
-        chunk = text[start:end]
-
-        # Try to break at sentence boundary
-        if end < len(text):
-            last_period = chunk.rfind(".")
-            last_newline = chunk.rfind("\n")
-            break_point = max(last_period, last_newline)
-            if break_point > start + chunk_size // 2:
-                chunk = text[start : break_point + 1]
-                end = break_point + 1
-
-        chunks.append(chunk.strip())
-        start = end - overlap
-
-        if start >= len(text):
+async def iter_upload_text(
+    file: UploadFile, block_size: int = 65536
+) -> AsyncIterator[str]:
+    """Decode an uploaded file as UTF-8 in blocks without reading it whole"""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    while True:
+        block = await asyncio.get_running_loop().run_in_executor(
+            io_executor, file.file.read, block_size
+        )
+        if not block:
             break
+        text = decoder.decode(block)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+def generate_point_ids(count: int) -> List[int]:
+    """Random uint64-range point IDs, cheaper on the wire than UUID strings"""
+    return point_id_rng.integers(1, 2**63 - 1, size=count, dtype=np.int64).tolist()
+
+
+def text_key(text: str) -> bytes:
+    """Compact digest identifying a text in the embedding cache"""
+    return hashlib.blake2b(
+        text.encode("utf-8", "surrogatepass"), digest_size=16
+    ).digest()
+
+
+async def embed_chunks(chunks: List[str]) -> np.ndarray:
+    """Embed chunks, sending each distinct uncached text to the service once"""
+    keys = [text_key(chunk) for chunk in chunks]
+
+    rows = {}
+    missing = {}
+    for key, chunk in zip(keys, chunks):
+        if key in rows or key in missing:
+            continue
+        cached = embedding_cache.get(key)
+        if cached is not None:
+            embedding_cache.move_to_end(key)
+            rows[key] = cached
+        else:
+            missing[key] = chunk
 
-    return [chunk for chunk in chunks if chunk.strip()]
+    if missing:
+        embeddings = await get_embeddings_batch(list(missing.values()))
+        for key, embedding in zip(missing, embeddings):
+            rows[key] = embedding
+            if EMBEDDING_CACHE_SIZE > 0:
+                embedding_cache[key] = embedding.copy()
+        while len(embedding_cache) > EMBEDDING_CACHE_SIZE:
+            embedding_cache.popitem(last=False)
 
+    if not keys:
+        return np.empty((0, 0), dtype=np.float32)
+    return np.stack([rows[key] for key in keys])
 
-async def get_embeddings_batch(texts: List[str]) -> List[List[float]]:
+
+async def get_embeddings_batch(texts: List[str]) -> np.ndarray:
     """Get embeddings from the embedding service with intelligent batching"""
+    if embedding_model is not None:
+        # Single-node mode: no HTTP hop, no serialization
+        embeddings = await asyncio.get_running_loop().run_in_executor(
+            encode_executor,
+            partial(
+                embedding_model.encode,
+                texts,
+                batch_size=MAX_BATCH_SIZE,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False,
+            ),
+        )
+        return embeddings.astype(np.float32, copy=False)
+
     if len(texts) <= MAX_BATCH_SIZE:
         return await _get_embeddings_single_batch(texts)
 
@@ -111,22 +276,65 @@ async def get_embeddings_batch(texts: List[str]) -> List[List[float]]:
     for i in range(0, len(texts), MAX_BATCH_SIZE):
         batch = texts[i : i + MAX_BATCH_SIZE]
         batch_embeddings = await _get_embeddings_single_batch(batch)
-        all_embeddings.extend(batch_embeddings)
+        all_embeddings.append(batch_embeddings)
 
-    return all_embeddings
+    return np.concatenate(all_embeddings)
 
 
-async def _get_embeddings_single_batch(texts: List[str]) -> List[List[float]]:
-    """Get embeddings for a single batch"""
+async def _get_embeddings_single_batch(texts: List[str]) -> np.ndarray:
+    """Get embeddings for a single batch as raw float16 rows"""
     async with request_semaphore:
         response = await http_client.post(
-            f"{EMBEDDING_SERVICE_URL}/embeddings", json={"texts": texts}
+            f"{EMBEDDING_SERVICE_URL}/embeddings",
+            json={"texts": texts},
+            headers={"Accept": "application/octet-stream"},
         )
         if response.status_code != 200:
             raise HTTPException(
                 status_code=500, detail=f"Embedding service error: {response.text}"
             )
-        return response.json()["embeddings"]
+        shape = response.headers.get("X-Shape")
+        if shape is None:
+            content_type = response.headers.get("content-type", "unknown")
+            raise HTTPException(
+                status_code=500,
+                detail=(
+                    "Embedding service error: expected binary float16 embeddings "
+                    f"with an X-Shape header, got {content_type}; "
+                    "is the embedding service up to date?"
+                ),
+            )
+        rows, dim = (int(n) for n in shape.split(","))
+        embeddings = np.frombuffer(response.content, dtype=EMBEDDING_WIRE_DTYPE)
+        return embeddings.reshape(rows, dim).astype(np.float32)
+
+
+async def store_chunks(
+    chunks: List[str], embeddings: np.ndarray, metadata: Dict
+) -> None:
+    """Upsert one document's chunks and their embeddings into Qdrant"""
+    point_ids = generate_point_ids(len(chunks))
+    points = []
+    for i, (chunk, embedding) in enumerate(zip(chunks, embeddings)):
+        points.append(
+            PointStruct(
+                id=point_ids[i],
+                vector=embedding.tolist(),
+                payload={"text": chunk, "chunk_index": i, **metadata},
+            )
+        )
+
+    # Send sub-batches concurrently and let the server pipeline the writes
+    await asyncio.gather(
+        *[
+            qdrant_client.upsert(
+                collection_name=COLLECTION_NAME,
+                points=points[i : i + UPSERT_BATCH_SIZE],
+                wait=False,
+            )
+            for i in range(0, len(points), UPSERT_BATCH_SIZE)
+        ]
+    )
 
 
 @app.get("/health")
@@ -142,21 +350,10 @@ async def ingest_document(document: Document):
         logger.info(f"Created {len(chunks)} chunks from document")
 
         # Get embeddings for all chunks with intelligent batching
-        embeddings = await get_embeddings_batch(chunks)
+        embeddings = await embed_chunks(chunks)
 
         # Store in Qdrant
-        points = []
-        for i, (chunk, embedding) in enumerate(zip(chunks, embeddings)):
-            point_id = str(uuid.uuid4())
-            points.append(
-                PointStruct(
-                    id=point_id,
-                    vector=embedding,
-                    payload={"text": chunk, "chunk_index": i, **document.metadata},
-                )
-            )
-
-        qdrant_client.upsert(collection_name=COLLECTION_NAME, points=points)
+        await store_chunks(chunks, embeddings, document.metadata)
 
         return {
             "message": f"Ingested document with {len(chunks)} chunks",
@@ -168,18 +365,113 @@ async def ingest_document(document: Document):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/ingest/bulk")
+async def ingest_documents_bulk(request: BulkIngestRequest):
+    try:
+        chunks = []
+        payloads = []
+        for document in request.documents:
+            document_chunks = chunk_text(document.text)
+            chunks.extend(document_chunks)
+            payloads.extend(
+                {"text": chunk, "chunk_index": i, **document.metadata}
+                for i, chunk in enumerate(document_chunks)
+            )
+        logger.info(
+            f"Created {len(chunks)} chunks from {len(request.documents)} documents"
+        )
+
+        if chunks:
+            embeddings = await embed_chunks(chunks)
+            ids = generate_point_ids(len(chunks))
+
+            async with bulk_ingest_lock:
+                # Pause HNSW indexing while loading so segments are indexed once
+                await qdrant_client.update_collection(
+                    collection_name=COLLECTION_NAME,
+                    optimizer_config=OptimizersConfigDiff(indexing_threshold=0),
+                )
+                try:
+                    await asyncio.get_running_loop().run_in_executor(
+                        io_executor,
+                        partial(
+                            qdrant_client.upload_collection,
+                            collection_name=COLLECTION_NAME,
+                            vectors=embeddings,
+                            payload=payloads,
+                            ids=ids,
+                            batch_size=UPSERT_BATCH_SIZE,
+                            parallel=UPLOAD_PARALLEL,
+                            wait=True,
+                        ),
+                    )
+                finally:
+                    await qdrant_client.update_collection(
+                        collection_name=COLLECTION_NAME,
+                        optimizer_config=OptimizersConfigDiff(
+                            indexing_threshold=INDEXING_THRESHOLD
+                        ),
+                    )
+
+        return {
+            "message": f"Ingested {len(request.documents)} documents "
+            f"with {len(chunks)} chunks",
+            "documents": len(request.documents),
+            "chunks": len(chunks),
+        }
+
+    except Exception as e:
+        logger.error(f"Error ingesting documents: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.post("/ingest/file")
 async def ingest_file(file: UploadFile = File(...)):
     try:
-        content = await file.read()
-        text = content.decode("utf-8")
-
-        document = Document(
-            text=text,
-            metadata={"filename": file.filename, "content_type": file.content_type},
+        # Chunk the upload as it is read and embed each batch as soon as it is
+        # ready, instead of holding the whole file as bytes and str
+        batches: asyncio.Queue = asyncio.Queue(maxsize=4)
+
+        async def produce_batches():
+            # The sentinel is only sent while the consumer is still reading;
+            # if it stopped, it cancelled us and a full queue would never drain
+            try:
+                batch = []
+                async for chunk in stream_chunks(iter_upload_text(file)):
+                    batch.append(chunk)
+                    if len(batch) == MAX_BATCH_SIZE:
+                        await batches.put(batch)
+                        batch = []
+                if batch:
+                    await batches.put(batch)
+            except Exception:
+                await batches.put(None)
+                raise
+            await batches.put(None)
+
+        producer = asyncio.create_task(produce_batches())
+        chunks = []
+        embeddings = []
+        try:
+            while (batch := await batches.get()) is not None:
+                chunks.extend(batch)
+                embeddings.append(await embed_chunks(batch))
+        finally:
+            if not producer.done():
+                producer.cancel()
+        await producer
+        logger.info(f"Created {len(chunks)} chunks from file {file.filename}")
+
+        await store_chunks(
+            chunks,
+            np.concatenate(embeddings) if embeddings else np.empty((0, 0)),
+            {"filename": file.filename, "content_type": file.content_type},
         )
 
-        return await ingest_document(document)
+        return {
+            "message": f"Ingested document with {len(chunks)} chunks",
+            "chunks": len(chunks),
+        }
 
     except Exception as e:
         logger.error(f"Error ingesting file: {e}")
@@ -189,15 +481,31 @@ async def ingest_file(file: UploadFile = File(...)):
 @app.post("/query", response_model=QueryResponse)
 async def query_documents(request: QueryRequest):
     try:
-        # Get embedding for query
-        query_embedding = await get_embeddings_batch([request.query])
+        # Get embedding for query, reusing it for repeats of popular queries
+        # Key on exactly the text that is embedded; trimming cannot change the
+        # vector, since tokenization strips too, but case can
+        query_text = request.query.strip()
+        cache_key = text_key(query_text)
+        query_embedding = query_cache.get(cache_key)
+        if query_embedding is None:
+            query_embedding = (await get_embeddings_batch([query_text]))[0]
+            if QUERY_CACHE_SIZE > 0:
+                query_cache[cache_key] = query_embedding.copy()
 
         # Search in Qdrant
-        search_results = qdrant_client.search(
-            collection_name=COLLECTION_NAME,
-            query_vector=query_embedding[0],
-            limit=request.limit,
-        )
+        search_results = (
+            await qdrant_client.query_points(
+                collection_name=COLLECTION_NAME,
+                query=query_embedding.tolist(),
+                limit=request.limit,
+                # Rescore oversampled int8 candidates with the original vectors
+                search_params=SearchParams(
+                    quantization=QuantizationSearchParams(
+                        rescore=True, oversampling=2.0
+                    )
+                ),
+            )
+        ).points
 
         results = []
         for result in search_results:
@@ -221,7 +529,7 @@ async def query_documents(request: QueryRequest):
 @app.get("/collections/info")
 async def get_collection_info():
     try:
-        info = qdrant_client.get_collection(COLLECTION_NAME)
+        info = await qdrant_client.get_collection(COLLECTION_NAME)
         return {"collection": COLLECTION_NAME, "info": info}
     except Exception as e:
         logger.error(f"Error getting collection info: {e}")
@@ -0,0 +1,160 @@
+"""
+Unit tests for the embedding service micro-batcher
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "embedding-service"))
+
+from batching import run_batcher  # noqa: E402
+
+
+class StubEncoder:
+    """Records each encode call; row i of a call holds the text's number"""
+
+    def __init__(self, fail=False):
+        self.calls = []
+        self.fail = fail
+        self.release = asyncio.Event()
+
+    async def __call__(self, texts):
+        self.calls.append(list(texts))
+        await self.release.wait()
+        if self.fail:
+            raise RuntimeError("encode failed")
+        return np.array([[float(text)] for text in texts], dtype=np.float32)
+
+
+async def start_batcher(encoder, batch_size=32, window_ms=5, concurrency=1):
+    queue = asyncio.Queue()
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = set()
+    task = asyncio.create_task(
+        run_batcher(queue, semaphore, encoder, batch_size, window_ms, tasks)
+    )
+    return queue, semaphore, task
+
+
+async def submit(queue, texts):
+    future = asyncio.get_running_loop().create_future()
+    await queue.put((texts, future))
+    return future
+
+
+async def stop(task):
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+
+def test_requests_queued_during_encode_are_coalesced():
+    async def run():
+        encoder = StubEncoder()
+        queue, _, task = await start_batcher(encoder)
+        first = await submit(queue, ["0"])
+        await asyncio.sleep(0.02)
+        # The only encode slot is busy, so these wait and go out together
+        rest = [await submit(queue, [str(i)]) for i in range(1, 8)]
+        encoder.release.set()
+        await asyncio.gather(first, *rest)
+        await stop(task)
+        return encoder.calls
+
+    calls = asyncio.run(run())
+    assert [len(call) for call in calls] == [1, 7]
+
+
+def test_each_caller_gets_its_own_rows():
+    async def run():
+        encoder = StubEncoder()
+        encoder.release.set()
+        queue, _, task = await start_batcher(encoder, window_ms=50)
+        futures = [
+            await submit(queue, ["1", "2"]),
+            await submit(queue, ["3"]),
+            await submit(queue, ["4", "5", "6"]),
+        ]
+        results = await asyncio.gather(*futures)
+        await stop(task)
+        return encoder.calls, results
+
+    calls, results = asyncio.run(run())
+    assert calls == [["1", "2", "3", "4", "5", "6"]]
+    assert [result[:, 0].tolist() for result in results] == [
+        [1.0, 2.0],
+        [3.0],
+        [4.0, 5.0, 6.0],
+    ]
+
+
+def test_batch_size_caps_a_coalesced_call():
+    async def run():
+        encoder = StubEncoder()
+        encoder.release.set()
+        queue, _, task = await start_batcher(encoder, batch_size=3, window_ms=50)
+        futures = [await submit(queue, [str(i)]) for i in range(5)]
+        await asyncio.gather(*futures)
+        await stop(task)
+        return encoder.calls
+
+    calls = asyncio.run(run())
+    assert calls == [["0", "1", "2"], ["3", "4"]]
+
+
+def test_encode_error_reaches_every_caller_and_frees_the_slot():
+    async def run():
+        encoder = StubEncoder(fail=True)
+        encoder.release.set()
+        queue, _, task = await start_batcher(encoder, window_ms=50)
+        futures = [await submit(queue, ["1"]), await submit(queue, ["2", "3"])]
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        # With one encode slot, this only completes if the failure released it
+        encoder.fail = False
+        later = await asyncio.wait_for(await submit(queue, ["4"]), 1)
+        await stop(task)
+        return results, later
+
+    results, later = asyncio.run(run())
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert later[:, 0].tolist() == [4.0]
+
+
+def test_cancelled_callers_are_skipped():
+    async def run():
+        encoder = StubEncoder()
+        queue, _, task = await start_batcher(encoder)
+        first = await submit(queue, ["0"])
+        await asyncio.sleep(0.02)
+        gone = await submit(queue, ["1"])
+        kept = await submit(queue, ["2"])
+        gone.cancel()
+        encoder.release.set()
+        await first
+        result = await kept
+        await stop(task)
+        return encoder.calls, result
+
+    calls, result = asyncio.run(run())
+    assert calls == [["0"], ["2"]]
+    assert result[:, 0].tolist() == [2.0]
+
+
+def test_batch_of_only_cancelled_callers_is_not_encoded():
+    async def run():
+        encoder = StubEncoder()
+        encoder.release.set()
+        queue, _, task = await start_batcher(encoder)
+        gone = await submit(queue, ["0"])
+        gone.cancel()
+        await asyncio.sleep(0.02)
+        kept = await submit(queue, ["1"])
+        await kept
+        await stop(task)
+        return encoder.calls
+
+    calls = asyncio.run(run())
+    assert calls == [["1"]]
@@ -0,0 +1,96 @@
+"""
+Unit tests for the RAG API text chunker
+"""
+import asyncio
+import random
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "rag-api"))
+
+import chunking  # noqa: E402
+from chunking import chunk_text, stream_chunks  # noqa: E402
+
+
+def sample_text(length, seed):
+    """Random text mixing sentence breaks, whitespace and non-ASCII characters"""
+    rng = random.Random(seed)
+    return "".join(rng.choice("abc é漢🙂.!?; \n\t\v\f\r") for _ in range(length))
+
+
+def collect_stream(text, block_size):
+    """Feed text to stream_chunks in block_size pieces and collect the chunks"""
+
+    async def pieces():
+        for i in range(0, len(text), block_size):
+            yield text[i : i + block_size]
+
+    async def collect():
+        return [chunk async for chunk in stream_chunks(pieces())]
+
+    return asyncio.run(collect())
+
+
+@pytest.fixture(params=["numpy", "hyperscan"])
+def break_finder(request, monkeypatch):
+    """Run each test with both break-point backends"""
+    if request.param == "numpy":
+        monkeypatch.setattr(chunking, "break_database", None)
+    elif chunking.break_database is None:
+        pytest.skip("hyperscan is not installed")
+
+
+def find_breaks_with_numpy(text):
+    """_find_breaks with the hyperscan database switched off"""
+    database = chunking.break_database
+    chunking.break_database = None
+    try:
+        return chunking._find_breaks(text)
+    finally:
+        chunking.break_database = database
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "Plain ASCII. Two sentences!\nAnd a line",
+        "Café. Naïve? 漢字。 Emoji 🙂! End; done.\n",
+        "Tab.\tVT.\vFF.\fCR.\rLF.\nNone.x",
+        "é.\v漢!\r🙂?\f",
+    ]
+    + [sample_text(2000, seed) for seed in range(20)],
+)
+def test_hyperscan_and_numpy_breaks_agree(text):
+    if chunking.break_database is None:
+        pytest.skip("hyperscan is not installed")
+    expected = find_breaks_with_numpy(text)
+    assert chunking._find_breaks(text).tolist() == expected.tolist()
+    assert all(text[i] in chunking.SENTENCE_END_CHARS + "\n" for i in expected)
+
+
+def test_short_text_is_single_chunk(break_finder):
+    assert chunk_text("Hello world.") == ["Hello world."]
+
+
+def test_chunks_break_after_sentence_end(break_finder):
+    text = ("This is one sentence. " * 40).strip()
+    chunks = chunk_text(text)
+    assert len(chunks) > 1
+    assert all(chunk.endswith(".") for chunk in chunks[:-1])
+    assert all(len(chunk) <= 500 for chunk in chunks)
+
+
+def test_period_without_whitespace_is_not_a_break(break_finder):
+    text = "x" * 400 + "3.14" + "y" * 400
+    assert chunk_text(text)[0] == text[:500]
+
+
+@pytest.mark.parametrize("block_size", [1, 7, 499, 500, 501, 4096, 65536])
+@pytest.mark.parametrize("length", [0, 10, 500, 501, 3000, 20000])
+def test_stream_chunks_matches_chunk_text(break_finder, block_size, length):
+    for seed in range(3):
+        text = sample_text(length, seed)
+        expected = [chunk.strip() for chunk in chunk_text(text) if chunk.strip()]
+        assert collect_stream(text, block_size) == expected
@@ -56,6 +56,32 @@ def test_document_ingestion():
         print(f"Ingestion error: {e}")
         return False
 
+def test_bulk_ingestion():
+    """Test bulk document ingestion"""
+    print("\nTesting bulk ingestion...")
+    
+    bulk_request = {
+        "documents": [
+            {
+                "text": "Qdrant is a vector database written in Rust. It stores embeddings and supports filtered similarity search.",
+                "metadata": {"source": "qdrant_intro", "topic": "databases"}
+            },
+            {
+                "text": "FastAPI is a Python web framework for building APIs. It uses type hints and Pydantic for validation.",
+                "metadata": {"source": "fastapi_intro", "topic": "programming"}
+            }
+        ]
+    }
+    
+    try:
+        response = requests.post(f"{RAG_API_URL}/ingest/bulk", json=bulk_request)
+        print(f"Bulk ingestion response: {response.status_code}")
+        print(f"Response: {response.json()}")
+        return response.status_code == 200 and response.json()["documents"] == 2
+    except Exception as e:
+        print(f"Bulk ingestion error: {e}")
+        return False
+
 def test_query():
     """Test querying the RAG system"""
     print("\nTesting queries...")
@@ -93,6 +119,8 @@ def main():
     
     test_health_checks()
     
+    test_bulk_ingestion()
+    
     if test_document_ingestion():
         # Wait a bit for indexing
         time.sleep(2)